@@ -1,19 +1,36 @@
 from __future__ import annotations
 
 import argparse
+import atexit
 import base64
+import concurrent.futures
 import ctypes
 import ctypes.wintypes as w
+import functools
+import http.client
+import io
 import json
+import queue
+import socket
 import struct
 import threading
 import time
-import urllib.request
+import urllib.parse
 import zlib
 from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 API_URL = "http://localhost:1234/v1/chat/completions"
 MODEL_NAME = "qwen3-vl-2b-instruct"
@@ -26,6 +43,19 @@ RES_PRESETS: dict[str, tuple[int, int]] = {
     "high": (1536, 864),
 }
 
+JPEG_QUALITY = 80
+REQUEST_TIMEOUT = 60.0
+CONNECT_TIMEOUT = 5.0
+REQUEST_RETRIES = 3
+MAX_RESPONSE_BYTES = 4 * 1024 * 1024
+ACTION_SETTLE = 0.2
+
+FRAME_HASH_SIZE = 16
+FRAME_CACHE_DISTANCE = 6
+FRAME_CACHE_HOLD = 5.0
+FRAME_CACHE_POLL = 0.25
+FRAME_CACHE_HOLD_TOOLS = frozenset({"attend"})
+
 COLOR_PALETTE: dict[str, int] = {
     "red": 0x000000FF,
     "green": 0x0000FF00,
@@ -69,6 +99,7 @@ SAMPLING: dict[str, object] = {
     "seed": 42,
 }
 
+@functools.cache
 def _get_color(name: str) -> int:
     return COLOR_PALETTE.get(name.lower(), COLOR_PALETTE["blue"])
 
@@ -243,7 +274,7 @@ TOOLS = [
         },
     },
 ]
-TOOL_NAME_SET: set[str] = {str(t["function"]["name"]).strip().lower() for t in TOOLS}
+TOOL_NAME_SET: frozenset[str] = frozenset(str(t["function"]["name"]).strip().lower() for t in TOOLS)
 
 
 
@@ -254,8 +285,30 @@ kernel32.GetCurrentProcessId.restype = w.DWORD
 user32.GetWindowThreadProcessId.argtypes = [w.HWND, ctypes.POINTER(w.DWORD)]
 user32.GetWindowThreadProcessId.restype = w.DWORD
 
-ctypes.WinDLL("Shcore").SetProcessDpiAwareness(2)
-kernel32.LoadLibraryW("Msftedit.dll")
+DPI_AWARENESS_CONTEXT_PER_MONITOR_AWARE_V2 = -4
+_env_inited = False
+_richedit_loaded = False
+
+
+def init_windows_env() -> None:
+    global _env_inited
+    if _env_inited:
+        return
+    _env_inited = True
+    set_ctx = getattr(user32, "SetProcessDpiAwarenessContext", None)
+    if set_ctx is not None:
+        set_ctx.argtypes = [w.HANDLE]
+        set_ctx.restype = w.BOOL
+        if set_ctx(DPI_AWARENESS_CONTEXT_PER_MONITOR_AWARE_V2):
+            return
+    ctypes.WinDLL("Shcore").SetProcessDpiAwareness(2)
+
+
+def _load_richedit() -> None:
+    global _richedit_loaded
+    if not _richedit_loaded:
+        kernel32.LoadLibraryW("Msftedit.dll")
+        _richedit_loaded = True
 
 INPUT_MOUSE, INPUT_KEYBOARD = 0, 1
 WHEEL_DELTA = 120
@@ -275,15 +328,22 @@ WS_EX_TRANSPARENT, WS_EX_TOOLWINDOW = 0x00000020, 0x00000080
 WM_SETFONT, WM_CLOSE, WM_DESTROY = 0x0030, 0x0010, 0x0002
 WM_COMMAND, WM_SIZE, WM_MOUSEWHEEL = 0x0111, 0x0005, 0x020A
 WM_GETTEXT, WM_GETTEXTLENGTH = 0x000D, 0x000E
+WM_ERASEBKGND, WM_QUIT = 0x0014, 0x0012
+WM_APP = 0x8000
+WM_APP_OBS_UPDATE = WM_APP + 1
 SMTO_BLOCK, SMTO_ABORTIFHUNG = 0x0001, 0x0002
+PM_REMOVE, QS_ALLINPUT = 0x0001, 0x04FF
+INFINITE, WAIT_OBJECT_0 = 0xFFFFFFFF, 0
 
 EM_SETBKGNDCOLOR, EM_SETREADONLY = 0x0443, 0x00CF
 EM_SETTARGETDEVICE, EM_SETZOOM = 0x0449, 0x04E1
 
-SW_SHOWNOACTIVATE = 4
+SW_HIDE, SW_SHOWNOACTIVATE = 0, 4
 SWP_NOMOVE, SWP_NOSIZE, SWP_NOACTIVATE, SWP_SHOWWINDOW = 0x0002, 0x0001, 0x0010, 0x0040
+SWP_NOZORDER, SWP_HIDEWINDOW, SWP_NOSENDCHANGING = 0x0004, 0x0080, 0x0400
 HWND_TOPMOST = -1
 SRCCOPY, CAPTUREBLT = 0x00CC0020, 0x40000000
+HALFTONE = 4
 LWA_ALPHA = 0x00000002
 CS_HREDRAW, CS_VREDRAW = 0x0002, 0x0001
 IDC_ARROW, COLOR_WINDOW = 32512, 5
@@ -383,6 +443,9 @@ _SIGNATURES: list[tuple[Any, list[tuple[str, list[Any], Any]]]] = [
             ("CreateWindowExW", [w.DWORD, w.LPCWSTR, w.LPCWSTR, w.DWORD, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, w.HWND, w.HMENU, w.HINSTANCE, w.LPVOID], w.HWND),
             ("ShowWindow", [w.HWND, ctypes.c_int], w.BOOL),
             ("SetWindowPos", [w.HWND, w.HWND, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_uint], w.BOOL),
+            ("BeginDeferWindowPos", [ctypes.c_int], w.HANDLE),
+            ("DeferWindowPos", [w.HANDLE, w.HWND, w.HWND, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_uint], w.HANDLE),
+            ("EndDeferWindowPos", [w.HANDLE], w.BOOL),
             ("DestroyWindow", [w.HWND], w.BOOL),
             ("SendInput", [ctypes.c_uint, ctypes.POINTER(INPUT), ctypes.c_int], ctypes.c_uint),
             ("GetSystemMetrics", [ctypes.c_int], ctypes.c_int),
@@ -391,7 +454,10 @@ _SIGNATURES: list[tuple[Any, list[tuple[str, list[Any], Any]]]] = [
             ("SetWindowTextW", [w.HWND, w.LPCWSTR], w.BOOL),
             ("SendMessageW", [w.HWND, ctypes.c_uint, w.WPARAM, w.LPARAM], w.LPARAM),
             ("PostMessageW", [w.HWND, ctypes.c_uint, w.WPARAM, w.LPARAM], w.BOOL),
+            ("PostThreadMessageW", [w.DWORD, ctypes.c_uint, w.WPARAM, w.LPARAM], w.BOOL),
             ("GetMessageW", [ctypes.POINTER(MSG), w.HWND, ctypes.c_uint, ctypes.c_uint], w.BOOL),
+            ("PeekMessageW", [ctypes.POINTER(MSG), w.HWND, ctypes.c_uint, ctypes.c_uint, ctypes.c_uint], w.BOOL),
+            ("MsgWaitForMultipleObjects", [w.DWORD, ctypes.POINTER(w.HANDLE), w.BOOL, w.DWORD, w.DWORD], w.DWORD),
             ("TranslateMessage", [ctypes.POINTER(MSG)], w.BOOL),
             ("DispatchMessageW", [ctypes.POINTER(MSG)], w.LPARAM),
             ("SetLayeredWindowAttributes", [w.HWND, w.COLORREF, ctypes.c_ubyte, w.DWORD], w.BOOL),
@@ -399,10 +465,12 @@ _SIGNATURES: list[tuple[Any, list[tuple[str, list[Any], Any]]]] = [
             ("RegisterClassExW", [ctypes.POINTER(WNDCLASSEXW)], w.ATOM),
             ("LoadCursorW", [w.HINSTANCE, w.LPCWSTR], w.HANDLE),
             ("GetClientRect", [w.HWND, ctypes.POINTER(RECT)], w.BOOL),
+            ("FillRect", [w.HDC, ctypes.POINTER(RECT), w.HANDLE], ctypes.c_int),
             ("MoveWindow", [w.HWND, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, w.BOOL], w.BOOL),
             ("GetWindowTextW", [w.HWND, w.LPWSTR, ctypes.c_int], ctypes.c_int),
             ("GetWindowTextLengthW", [w.HWND], ctypes.c_int),
             ("GetAsyncKeyState", [ctypes.c_int], ctypes.c_short),
+            ("GetDoubleClickTime", [], ctypes.c_uint),
             ("EnumWindows", [WNDENUMPROC, w.LPARAM], w.BOOL),
             ("EnumChildWindows", [w.HWND, WNDENUMPROC, w.LPARAM], w.BOOL),
             ("IsWindowVisible", [w.HWND], w.BOOL),
@@ -411,7 +479,16 @@ _SIGNATURES: list[tuple[Any, list[tuple[str, list[Any], Any]]]] = [
             ("SendMessageTimeoutW", [w.HWND, ctypes.c_uint, w.WPARAM, w.LPARAM, ctypes.c_uint, ctypes.c_uint, ctypes.POINTER(ctypes.c_size_t)], w.LPARAM),
         ],
     ),
-    (kernel32, [("GetModuleHandleW", [w.LPCWSTR], w.HMODULE)]),
+    (
+        kernel32,
+        [
+            ("GetModuleHandleW", [w.LPCWSTR], w.HMODULE),
+            ("GetCurrentThreadId", [], w.DWORD),
+            ("CreateEventW", [ctypes.c_void_p, w.BOOL, w.BOOL, w.LPCWSTR], w.HANDLE),
+            ("SetEvent", [w.HANDLE], w.BOOL),
+            ("CloseHandle", [w.HANDLE], w.BOOL),
+        ],
+    ),
 ]
 
 for dll, funcs in _SIGNATURES:
@@ -420,32 +497,85 @@ for dll, funcs in _SIGNATURES:
         fn.argtypes = args
         fn.restype = res
 
+_SendMessageW = user32.SendMessageW
+_SetWindowTextW = user32.SetWindowTextW
+_MoveWindow = user32.MoveWindow
+_SetWindowPos = user32.SetWindowPos
+_PeekMessageW = user32.PeekMessageW
+_MsgWaitForMultipleObjects = user32.MsgWaitForMultipleObjects
+_TranslateMessage = user32.TranslateMessage
+_DispatchMessageW = user32.DispatchMessageW
+_DefWindowProcW = user32.DefWindowProcW
+
+_EMPTY_W = ctypes.c_wchar_p("")
+_CLS_RICHEDIT = ctypes.c_wchar_p("RICHEDIT50W")
+_CLS_BUTTON = ctypes.c_wchar_p("BUTTON")
+_LBL_RESUME = ctypes.c_wchar_p("RESUME")
+_LBL_PAUSE = ctypes.c_wchar_p("PAUSE")
+
+
+def _pump_messages(stop_handle: w.HANDLE, on_thread_msg: Callable[[int], None] | None = None) -> None:
+    msg = MSG()
+    pmsg = ctypes.byref(msg)
+    handles = (w.HANDLE * 1)(stop_handle)
+    while _MsgWaitForMultipleObjects(1, handles, False, INFINITE, QS_ALLINPUT) == WAIT_OBJECT_0 + 1:
+        while _PeekMessageW(pmsg, None, 0, 0, PM_REMOVE):
+            if msg.message == WM_QUIT:
+                return
+            if not msg.hwnd and on_thread_msg is not None:
+                on_thread_msg(msg.message)
+                continue
+            _TranslateMessage(pmsg)
+            _DispatchMessageW(pmsg)
+
 
 @dataclass(slots=True)
 class Coord:
     sw: int
     sh: int
+    _sx: float = field(init=False, default=0.0)
+    _sy: float = field(init=False, default=0.0)
+    _win_sx: float = field(init=False, default=0.0)
+    _win_sy: float = field(init=False, default=0.0)
+    _max_x: int = field(init=False, default=0)
+    _max_y: int = field(init=False, default=0)
+
+    def __post_init__(self) -> None:
+        self._sx = self.sw / 1000
+        self._sy = self.sh / 1000
+        self._max_x = max(0, self.sw - 1)
+        self._max_y = max(0, self.sh - 1)
+        self._win_sx = 65535 / self.sw if self.sw > 0 else 0.0
+        self._win_sy = 65535 / self.sh if self.sh > 0 else 0.0
 
     def to_screen(self, x: float, y: float) -> tuple[int, int]:
-        nx = max(0.0, min(1000.0, x)) * self.sw / 1000
-        ny = max(0.0, min(1000.0, y)) * self.sh / 1000
-        return int(nx), int(ny)
+        px = int((x if x < 1000.0 else 1000.0) * self._sx) if x > 0.0 else 0
+        py = int((y if y < 1000.0 else 1000.0) * self._sy) if y > 0.0 else 0
+        mx, my = self._max_x, self._max_y
+        return (px if px < mx else mx), (py if py < my else my)
+
+    def to_screen_batch(self, xs: list[float], ys: list[float]) -> tuple[list[int], list[int]]:
+        sx, sy, mx, my = self._sx, self._sy, self._max_x, self._max_y
+        return [min(int((x if x < 1000.0 else 1000.0) * sx), mx) if x > 0.0 else 0 for x in xs], [min(int((y if y < 1000.0 else 1000.0) * sy), my) if y > 0.0 else 0 for y in ys]
 
     def to_win32(self, x: int, y: int) -> tuple[int, int]:
-        wx = (x * 65535 // self.sw) if self.sw > 0 else 0
-        wy = (y * 65535 // self.sh) if self.sh > 0 else 0
-        return wx, wy
+        return int(x * self._win_sx), int(y * self._win_sy)
+
+
+_DOUBLE_CLICK_GAP = min(0.05, user32.GetDoubleClickTime() / 2000)
+_DRAG_SETTLE = 0.05
 
 
 def clamp(v: int, lo: int, hi: int) -> int:
     return max(lo, min(hi, v))
 
 
-def send_input(inputs: list[INPUT]) -> None:
-    arr = (INPUT * len(inputs))(*inputs)
-    if user32.SendInput(len(arr), arr, ctypes.sizeof(INPUT)) != len(inputs):
+def send_input(inputs: list[INPUT] | ctypes.Array, settle: float = 0.0) -> None:
+    arr = inputs if isinstance(inputs, ctypes.Array) else (INPUT * len(inputs))(*inputs)
+    if user32.SendInput(len(arr), arr, ctypes.sizeof(INPUT)) != len(arr):
         raise ctypes.WinError(ctypes.get_last_error())
-    time.sleep(0.05)
+    if settle > 0:
+        time.sleep(settle)
 
 
 def make_mouse_input(dx: int, dy: int, flags: int, data: int = 0) -> INPUT:
@@ -467,21 +597,21 @@ def mouse_right_click(x: int, y: int, conv: Coord) -> None:
 
 def mouse_double_click(x: int, y: int, conv: Coord) -> None:
     wx, wy = conv.to_win32(x, y)
-    send_input([make_mouse_input(wx, wy, MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE), make_mouse_input(0, 0, MOUSEEVENTF_LEFTDOWN), make_mouse_input(0, 0, MOUSEEVENTF_LEFTUP)])
-    time.sleep(0.05)
+    send_input([make_mouse_input(wx, wy, MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE), make_mouse_input(0, 0, MOUSEEVENTF_LEFTDOWN), make_mouse_input(0, 0, MOUSEEVENTF_LEFTUP)], settle=_DOUBLE_CLICK_GAP)
     send_input([make_mouse_input(0, 0, MOUSEEVENTF_LEFTDOWN), make_mouse_input(0, 0, MOUSEEVENTF_LEFTUP)])
 
 
 def mouse_drag(x1: int, y1: int, x2: int, y2: int, conv: Coord) -> None:
     wx1, wy1 = conv.to_win32(x1, y1)
     wx2, wy2 = conv.to_win32(x2, y2)
-    send_input([make_mouse_input(wx1, wy1, MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE), make_mouse_input(0, 0, MOUSEEVENTF_LEFTDOWN)])
-    time.sleep(0.05)
-    for i in range(1, 11):
-        ix = int(wx1 + (wx2 - wx1) * i / 10)
-        iy = int(wy1 + (wy2 - wy1) * i / 10)
-        send_input([make_mouse_input(ix, iy, MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE)])
-        time.sleep(0.01)
+    points = [(int(wx1 + (wx2 - wx1) * i / 10), int(wy1 + (wy2 - wy1) * i / 10)) for i in range(1, 11)]
+    moves = (INPUT * len(points))()
+    for inp, (ix, iy) in zip(moves, points):
+        inp.type = INPUT_MOUSE
+        inp.union.mi.dx, inp.union.mi.dy = ix, iy
+        inp.union.mi.dwFlags = MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE
+    send_input([make_mouse_input(wx1, wy1, MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE), make_mouse_input(0, 0, MOUSEEVENTF_LEFTDOWN)], settle=_DRAG_SETTLE)
+    send_input(moves, settle=_DRAG_SETTLE)
     send_input([make_mouse_input(0, 0, MOUSEEVENTF_LEFTUP)])
 
 
@@ -489,18 +619,18 @@ def type_text(text: str) -> None:
     if not text:
         return
     utf16 = text.encode("utf-16le")
-    inputs: list[INPUT] = []
-    for i in range(0, len(utf16), 2):
-        code = utf16[i] | (utf16[i + 1] << 8)
-        d = INPUT()
+    n = len(utf16) // 2
+    arr = (INPUT * (2 * n))()
+    for i, code in enumerate(struct.unpack(f"<{n}H", utf16)):
+        d = arr[2 * i]
         d.type = INPUT_KEYBOARD
-        d.union.ki = KEYBDINPUT(wVk=0, wScan=code, dwFlags=KEYEVENTF_UNICODE, time=0, dwExtraInfo=None)
-        inputs.append(d)
-        u = INPUT()
+        d.union.ki.wScan = code
+        d.union.ki.dwFlags = KEYEVENTF_UNICODE
+        u = arr[2 * i + 1]
         u.type = INPUT_KEYBOARD
-        u.union.ki = KEYBDINPUT(wVk=0, wScan=code, dwFlags=KEYEVENTF_UNICODE | KEYEVENTF_KEYUP, time=0, dwExtraInfo=None)
-        inputs.append(u)
-    send_input(inputs)
+        u.union.ki.wScan = code
+        u.union.ki.dwFlags = KEYEVENTF_UNICODE | KEYEVENTF_KEYUP
+    send_input(arr)
 
 
 def scroll(dy: float) -> None:
@@ -515,6 +645,30 @@ def _get_class_name(hwnd: w.HWND) -> str:
     return buf.value[:n] if n > 0 else ""
 
 
+GETTEXT_WALL_TIMEOUT = 0.3
+MAX_LOGGED_CHILDREN = 32
+_SKIP_CLASSES: frozenset[str] = frozenset(
+    {
+        "Chrome_RenderWidgetHostHWND",
+        "Chrome_WidgetWin_0",
+        "Intermediate D3D Window",
+        "CefBrowserWindow",
+        "MSCTFIME UI",
+        "IME",
+        "ScrollBar",
+        "msctls_progress32",
+    }
+)
+_GETTEXT_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="franz-gettext")
+_IO_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="franz-io")
+_VLM_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="franz-vlm")
+
+EXEC_LOG_MODES = ("off", "basic", "full")
+_LOG_Q: queue.Queue[tuple[Path, Callable[[], str]] | None] = queue.Queue(maxsize=32)
+_LOG_LOCK = threading.Lock()
+_log_thread: threading.Thread | None = None
+
+
 def _safe_sendmessage_wm_gettext(hwnd: w.HWND, max_chars: int = 16384, timeout_ms: int = 200) -> str:
     if max_chars <= 1:
         return ""
@@ -541,34 +695,147 @@ def _format_multiline(text: str, indent: str) -> str:
     return "\n".join(indent + line for line in t.split("\n"))
 
 
-def append_execution_log(dump: Path, image_name: str, sw: int, sh: int) -> None:
+_ENUM_SINK: list[w.HWND] = []
+_ENUM_LOCK = threading.Lock()
+
+
+def _enum_collect(hwnd: w.HWND, lparam: w.LPARAM) -> w.BOOL:
+    _ENUM_SINK.append(hwnd)
+    return True
+
+
+_ENUM_COLLECT_PROC = WNDENUMPROC(_enum_collect)
+
+
+def _enum_hwnds(parent: w.HWND | None = None) -> list[w.HWND]:
+    with _ENUM_LOCK:
+        _ENUM_SINK.clear()
+        if parent is None:
+            user32.EnumWindows(_ENUM_COLLECT_PROC, 0)
+        else:
+            user32.EnumChildWindows(parent, _ENUM_COLLECT_PROC, 0)
+        hwnds = _ENUM_SINK[:]
+        _ENUM_SINK.clear()
+    return hwnds
+
+
+_WindowEntry = tuple[int, w.HWND, str, RECT, str, list[tuple[w.HWND, str, str]]]
+
+
+def _log_worker() -> None:
+    while (item := _LOG_Q.get()) is not None:
+        log_path, render = item
+        try:
+            text = render()
+        except Exception as e:
+            ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            text = f"--- {ts} | log_error={e!r}\n"
+        try:
+            log_path.parent.mkdir(parents=True, exist_ok=True)
+            with log_path.open("a", encoding="utf-8", errors="replace", newline="\n") as f:
+                f.write(text)
+        except OSError:
+            pass
+
+
+def _enqueue_log(log_path: Path, render: Callable[[], str]) -> None:
+    global _log_thread
+    with _LOG_LOCK:
+        if _log_thread is None:
+            _log_thread = threading.Thread(target=_log_worker, name="franz-log", daemon=True)
+            _log_thread.start()
+    while True:
+        try:
+            _LOG_Q.put_nowait((log_path, render))
+            return
+        except queue.Full:
+            try:
+                _LOG_Q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+def _flush_log() -> None:
+    global _log_thread
+    with _LOG_LOCK:
+        thread, _log_thread = _log_thread, None
+    if thread is None:
+        return
+    try:
+        _LOG_Q.put(None, timeout=1.0)
+    except queue.Full:
+        return
+    thread.join(timeout=2.0)
+
+
+atexit.register(_flush_log)
+
+
+def _render_execution_log(header: str, errors: list[str], entries: list[_WindowEntry], full: bool) -> str:
+    lines: list[str] = [header, *errors]
+    texts: dict[w.HWND, concurrent.futures.Future[str]] = {}
+    if full:
+        for _, hwnd, _, _, _, child_info in entries:
+            texts[hwnd] = _GETTEXT_POOL.submit(_safe_sendmessage_wm_gettext, hwnd)
+            for ch, _, _ in child_info:
+                texts[ch] = _GETTEXT_POOL.submit(_safe_sendmessage_wm_gettext, ch)
+        concurrent.futures.wait(texts.values(), timeout=GETTEXT_WALL_TIMEOUT)
+
+    def _text(h: w.HWND) -> str:
+        fut = texts.get(h)
+        if fut is None or not fut.done() or fut.exception() is not None:
+            return ""
+        return fut.result()
+
+    for i, hwnd, cls, r, title, child_info in entries:
+        lines.append(
+            f"[{i:03d}] hwnd=0x{int(hwnd):016X} class={cls} rect=({r.left},{r.top},{r.right},{r.bottom}) title={title!r}\n"
+        )
+        top_text = _text(hwnd)
+        if top_text and top_text != title:
+            mt = _format_multiline(top_text, "    ")
+            if mt:
+                lines.append("    wm_gettext:\n")
+                lines.append(mt + "\n")
+
+        for ch, ch_cls, crect in child_info:
+            mt = _format_multiline(_text(ch), "        ")
+            if mt:
+                lines.append(f"    child hwnd=0x{int(ch):016X} class={ch_cls} rect={crect}\n")
+                lines.append(mt + "\n")
+
+    lines.append("\n")
+    return "".join(lines)
+
+
+def append_execution_log(dump: Path, image_name: str, sw: int, sh: int, mode: str = "full") -> None:
+    if mode == "off":
+        return
+    full = mode == "full"
     log_path = dump / "execution-log.txt"
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
     pid = int(kernel32.GetCurrentProcessId())
-    lines: list[str] = [f"=== {ts} | pid={pid} | image={image_name} ===\n"]
+    header = f"=== {ts} | pid={pid} | image={image_name} ===\n"
+    errors: list[str] = []
     windows: list[w.HWND] = []
-
-    @WNDENUMPROC
-    def _enum_proc(hwnd: w.HWND, lparam: w.LPARAM) -> w.BOOL:
+    pid_out = w.DWORD()
+    for hwnd in _enum_hwnds():
         try:
             if not user32.IsWindowVisible(hwnd):
-                return True
-            pid_out = w.DWORD()
+                continue
             user32.GetWindowThreadProcessId(hwnd, ctypes.byref(pid_out))
             if int(pid_out.value) != pid:
-                return True
+                continue
             r = RECT()
             if not user32.GetWindowRect(hwnd, ctypes.byref(r)):
-                return True
+                continue
             if r.right <= 0 or r.bottom <= 0 or r.left >= sw or r.top >= sh:
-                return True
+                continue
             windows.append(hwnd)
         except Exception:
             pass
-        return True
-
-    user32.EnumWindows(_enum_proc, 0)
 
+    entries: list[_WindowEntry] = []
     for i, hwnd in enumerate(windows, 1):
         try:
             r = RECT()
@@ -581,179 +848,229 @@ def append_execution_log(dump: Path, image_name: str, sw: int, sh: int) -> None:
                 user32.GetWindowTextW(hwnd, tbuf, title_len + 1)
                 title = tbuf.value
 
-            cls = _get_class_name(hwnd)
-            top_text = _safe_sendmessage_wm_gettext(hwnd)
-
-            lines.append(
-                f"[{i:03d}] hwnd=0x{int(hwnd):016X} class={cls} rect=({r.left},{r.top},{r.right},{r.bottom}) title={title!r}\n"
-            )
-            if top_text and top_text != title:
-                mt = _format_multiline(top_text, "    ")
-                if mt:
-                    lines.append("    wm_gettext:\n")
-                    lines.append(mt + "\n")
-
-            children: list[w.HWND] = []
-
-            @WNDENUMPROC
-            def _enum_child(ch: w.HWND, lp: w.LPARAM) -> w.BOOL:
-                try:
-                    if user32.IsWindowVisible(ch):
-                        children.append(ch)
-                except Exception:
-                    pass
-                return True
-
-            user32.EnumChildWindows(hwnd, _enum_child, 0)
+            children = [ch for ch in _enum_hwnds(hwnd) if user32.IsWindowVisible(ch)] if full else []
 
+            child_info: list[tuple[w.HWND, str, str]] = []
             for ch in children:
-                txt = _safe_sendmessage_wm_gettext(ch)
-                if not txt:
-                    continue
                 ch_cls = _get_class_name(ch)
+                if ch_cls in _SKIP_CLASSES:
+                    continue
                 cr = RECT()
                 crect = "(?, ?, ?, ?)"
                 if user32.GetWindowRect(ch, ctypes.byref(cr)):
                     crect = f"({cr.left},{cr.top},{cr.right},{cr.bottom})"
-                mt = _format_multiline(txt, "        ")
-                if mt:
-                    lines.append(f"    child hwnd=0x{int(ch):016X} class={ch_cls} rect={crect}\n")
-                    lines.append(mt + "\n")
+                child_info.append((ch, ch_cls, crect))
+                if len(child_info) >= MAX_LOGGED_CHILDREN:
+                    break
+            entries.append((i, hwnd, _get_class_name(hwnd), r, title, child_info))
         except Exception as e:
-            lines.append(f"[{i:03d}] hwnd=0x{int(hwnd):016X} log_error={e}\n")
+            errors.append(f"[{i:03d}] hwnd=0x{int(hwnd):016X} log_error={e}\n")
 
-    lines.append("\n")
-    log_path.parent.mkdir(parents=True, exist_ok=True)
-    with log_path.open("a", encoding="utf-8", errors="replace", newline="\n") as f:
-        f.write("".join(lines))
+    _enqueue_log(log_path, lambda: _render_execution_log(header, errors, entries, full))
 
 
+@dataclass(slots=True)
+class _CaptureCtx:
+    sdc: w.HDC | None = None
+    mdc: w.HDC | None = None
+    hbm: w.HBITMAP | None = None
+    bits: ctypes.c_void_p = field(default_factory=ctypes.c_void_p)
+    w: int = 0
+    h: int = 0
 
+    def ensure(self, dw: int, dh: int) -> None:
+        if self.hbm and (self.w, self.h) == (dw, dh):
+            return
+        self.close()
 
-def capture_screen(sw: int, sh: int) -> bytes:
-    sdc = user32.GetDC(0)
-    if not sdc:
-        raise ctypes.WinError(ctypes.get_last_error())
+        self.sdc = user32.GetDC(0)
+        if not self.sdc:
+            raise ctypes.WinError(ctypes.get_last_error())
 
-    mdc = gdi32.CreateCompatibleDC(sdc)
-    if not mdc:
-        user32.ReleaseDC(0, sdc)
-        raise ctypes.WinError(ctypes.get_last_error())
+        self.mdc = gdi32.CreateCompatibleDC(self.sdc)
+        if not self.mdc:
+            err = ctypes.get_last_error()
+            self.close()
+            raise ctypes.WinError(err)
+
+        bmi = BITMAPINFO()
+        bmi.bmiHeader.biSize = ctypes.sizeof(BITMAPINFOHEADER)
+        bmi.bmiHeader.biWidth, bmi.bmiHeader.biHeight = dw, -dh
+        bmi.bmiHeader.biPlanes, bmi.bmiHeader.biBitCount = 1, 32
+
+        self.hbm = gdi32.CreateDIBSection(self.sdc, ctypes.byref(bmi), 0, ctypes.byref(self.bits), None, 0)
+        if not self.hbm:
+            err = ctypes.get_last_error()
+            self.close()
+            raise ctypes.WinError(err)
+
+        gdi32.SelectObject(self.mdc, self.hbm)
+        gdi32.SetStretchBltMode(self.mdc, HALFTONE)
+        self.w, self.h = dw, dh
+
+    def close(self) -> None:
+        if self.mdc:
+            gdi32.DeleteDC(self.mdc)
+        if self.hbm:
+            gdi32.DeleteObject(self.hbm)
+        if self.sdc:
+            user32.ReleaseDC(0, self.sdc)
+        self.sdc = self.mdc = self.hbm = None
+        self.bits = ctypes.c_void_p()
+        self.w = self.h = 0
+
+    def get_view(self) -> ctypes.Array:
+        return ctypes.cast(self.bits, ctypes.POINTER(ctypes.c_uint8 * (self.w * self.h * 4))).contents
+
+
+_CAPTURE = _CaptureCtx()
+atexit.register(_CAPTURE.close)
+
+
+def capture_and_downsample(sw: int, sh: int, dw: int, dh: int) -> memoryview:
+    ctx = _CAPTURE
+    ctx.ensure(dw, dh)
+    if (sw, sh) == (dw, dh):
+        ok = gdi32.BitBlt(ctx.mdc, 0, 0, sw, sh, ctx.sdc, 0, 0, SRCCOPY | CAPTUREBLT)
+    else:
+        ok = gdi32.StretchBlt(ctx.mdc, 0, 0, dw, dh, ctx.sdc, 0, 0, sw, sh, SRCCOPY | CAPTUREBLT)
+    if not ok:
+        err = ctypes.get_last_error()
+        ctx.close()
+        raise ctypes.WinError(err)
+    return memoryview(ctx.get_view()).cast("B")
+
+
+def capture_screen(sw: int, sh: int) -> memoryview:
+    return capture_and_downsample(sw, sh, sw, sh)
+
+
+def encode_png(bgra: bytes | memoryview, width: int, height: int) -> bytes:
+    if Image is not None:
+        buf = io.BytesIO()
+        Image.frombuffer("RGB", (width, height), bgra, "raw", "BGRX", 0, 1).save(buf, "PNG", compress_level=1)
+        return buf.getvalue()
+    rgb = bytearray(width * height * 3)
+    rgb[0::3] = bgra[2::4]
+    rgb[1::3] = bgra[1::4]
+    rgb[2::3] = bgra[0::4]
+    stride = width * 3
+    view = memoryview(rgb)
+    co = zlib.compressobj(1)
+    parts = [co.compress(b"\x00" + view[y * stride : (y + 1) * stride]) for y in range(height)]
+    parts.append(co.flush())
+    comp = b"".join(parts)
+    ihdr = struct.pack(">2I5B", width, height, 8, 2, 0, 0, 0)
 
-    bmi = BITMAPINFO()
-    bmi.bmiHeader.biSize = ctypes.sizeof(BITMAPINFOHEADER)
-    bmi.bmiHeader.biWidth, bmi.bmiHeader.biHeight = sw, -sh
-    bmi.bmiHeader.biPlanes, bmi.bmiHeader.biBitCount = 1, 32
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
 
-    bits = ctypes.c_void_p()
-    hbm = gdi32.CreateDIBSection(sdc, ctypes.byref(bmi), 0, ctypes.byref(bits), None, 0)
-    if not hbm:
-        gdi32.DeleteDC(mdc)
-        user32.ReleaseDC(0, sdc)
-        raise ctypes.WinError(ctypes.get_last_error())
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", comp) + chunk(b"IEND", b"")
 
-    gdi32.SelectObject(mdc, hbm)
 
-    if not gdi32.BitBlt(mdc, 0, 0, sw, sh, sdc, 0, 0, SRCCOPY | CAPTUREBLT):
-        gdi32.DeleteObject(hbm)
-        gdi32.DeleteDC(mdc)
-        user32.ReleaseDC(0, sdc)
-        raise ctypes.WinError(ctypes.get_last_error())
+def encode_jpeg(bgra: bytes | memoryview, width: int, height: int) -> bytes:
+    buf = io.BytesIO()
+    Image.frombuffer("RGB", (width, height), bgra, "raw", "BGRX", 0, 1).save(buf, "JPEG", quality=JPEG_QUALITY, optimize=False)
+    return buf.getvalue()
 
-    out = ctypes.string_at(bits, sw * sh * 4)
-    user32.ReleaseDC(0, sdc)
-    gdi32.DeleteDC(mdc)
-    gdi32.DeleteObject(hbm)
-    return out
 
+def frame_dhash(bgra: bytes | memoryview, width: int, height: int, step: int = 8) -> int:
+    cols, rows = FRAME_HASH_SIZE + 1, FRAME_HASH_SIZE
+    cell_w, cell_h = width // cols, height // rows
+    if cell_w <= 0 or cell_h <= 0:
+        return 0
+    green = bgra[1::4]
+    bits = 0
+    for r in range(rows):
+        ys = range(r * cell_h, (r + 1) * cell_h, step)
+        cells = [sum(sum(green[y * width + c * cell_w : y * width + (c + 1) * cell_w : step]) for y in ys) for c in range(cols)]
+        for c in range(FRAME_HASH_SIZE):
+            bits = (bits << 1) | (cells[c + 1] > cells[c])
+    return bits
 
-def downsample(src: bytes, sw: int, sh: int, dw: int, dh: int) -> bytes:
-    if (sw, sh) == (dw, dh):
-        return src
-    if sw <= 0 or sh <= 0 or dw <= 0 or dh <= 0 or len(src) < sw * sh * 4:
-        return b""
 
-    sdc = user32.GetDC(0)
-    if not sdc:
-        raise ctypes.WinError(ctypes.get_last_error())
+@dataclass(slots=True)
+class FrameCache:
+    last_hash: int | None = None
+    last_time: float = 0.0
 
-    try:
-        src_dc = gdi32.CreateCompatibleDC(sdc)
-        dst_dc = gdi32.CreateCompatibleDC(sdc)
-        if not src_dc or not dst_dc:
-            raise ctypes.WinError(ctypes.get_last_error())
+    def unchanged(self, h: int) -> bool:
+        if self.last_hash is None or time.perf_counter() - self.last_time >= FRAME_CACHE_HOLD:
+            return False
+        return (self.last_hash ^ h).bit_count() < FRAME_CACHE_DISTANCE
 
-        bmi_src = BITMAPINFO()
-        bmi_src.bmiHeader.biSize = ctypes.sizeof(BITMAPINFOHEADER)
-        bmi_src.bmiHeader.biWidth, bmi_src.bmiHeader.biHeight = sw, -sh
-        bmi_src.bmiHeader.biPlanes, bmi_src.bmiHeader.biBitCount = 1, 32
+    def store(self, h: int, tool: str) -> None:
+        self.last_hash = h if tool in FRAME_CACHE_HOLD_TOOLS else None
+        self.last_time = time.perf_counter()
 
-        src_bits = ctypes.c_void_p()
-        src_bmp = gdi32.CreateDIBSection(sdc, ctypes.byref(bmi_src), 0, ctypes.byref(src_bits), None, 0)
-        if not src_bmp or not src_bits:
-            raise ctypes.WinError(ctypes.get_last_error())
 
-        old_src = gdi32.SelectObject(src_dc, src_bmp)
-        ctypes.memmove(src_bits, src, sw * sh * 4)
+def create_shared_fonts() -> tuple[w.HFONT, w.HFONT]:
+    mono = gdi32.CreateFontW(-14, 0, 0, 0, 400, 0, 0, 0, 1, 0, 0, 0, 0, "Consolas")
+    ui = gdi32.CreateFontW(-14, 0, 0, 0, 700, 0, 0, 0, 1, 0, 0, 0, 0, "Segoe UI")
+    return mono, ui
 
-        bmi_dst = BITMAPINFO()
-        bmi_dst.bmiHeader.biSize = ctypes.sizeof(BITMAPINFOHEADER)
-        bmi_dst.bmiHeader.biWidth, bmi_dst.bmiHeader.biHeight = dw, -dh
-        bmi_dst.bmiHeader.biPlanes, bmi_dst.bmiHeader.biBitCount = 1, 32
 
-        dst_bits = ctypes.c_void_p()
-        dst_bmp = gdi32.CreateDIBSection(sdc, ctypes.byref(bmi_dst), 0, ctypes.byref(dst_bits), None, 0)
-        if not dst_bmp or not dst_bits:
-            raise ctypes.WinError(ctypes.get_last_error())
+OBS_CLASS_NAME = "FRANZLabeledObs"
+_CLS_OBS = ctypes.c_wchar_p(OBS_CLASS_NAME)
 
-        old_dst = gdi32.SelectObject(dst_dc, dst_bmp)
-        gdi32.SetStretchBltMode(dst_dc, 4)
+_BRUSH_CACHE: dict[int, w.HANDLE] = {}
+_OBS_WINDOWS: dict[int, LabeledObsWindow] = {}
+_OBS_CLASS_LOCK = threading.Lock()
+_obs_class_atom = 0
 
-        if not gdi32.StretchBlt(dst_dc, 0, 0, dw, dh, src_dc, 0, 0, sw, sh, SRCCOPY):
-            raise ctypes.WinError(ctypes.get_last_error())
 
-        result = ctypes.string_at(dst_bits, dw * dh * 4)
-
-        gdi32.SelectObject(src_dc, old_src)
-        gdi32.SelectObject(dst_dc, old_dst)
-        gdi32.DeleteObject(src_bmp)
-        gdi32.DeleteObject(dst_bmp)
-        gdi32.DeleteDC(src_dc)
-        gdi32.DeleteDC(dst_dc)
-        return result
-    finally:
-        user32.ReleaseDC(0, sdc)
-
-
-def encode_png(bgra: bytes, width: int, height: int) -> bytes:
-    raw = bytearray((width * 3 + 1) * height)
-    for y in range(height):
-        raw[y * (width * 3 + 1)] = 0
-        row = bgra[y * width * 4 : (y + 1) * width * 4]
-        for x in range(width):
-            raw[y * (width * 3 + 1) + 1 + x * 3 : y * (width * 3 + 1) + 1 + x * 3 + 3] = [row[x * 4 + 2], row[x * 4 + 1], row[x * 4 + 0]]
-    comp = zlib.compress(bytes(raw), 6)
-    ihdr = struct.pack(">2I5B", width, height, 8, 2, 0, 0, 0)
+def get_brush(color: int) -> w.HANDLE:
+    with _OBS_CLASS_LOCK:
+        brush = _BRUSH_CACHE.get(color)
+        if brush is None:
+            brush = _BRUSH_CACHE[color] = gdi32.CreateSolidBrush(color)
+        return brush
 
-    def chunk(tag: bytes, data: bytes) -> bytes:
-        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
 
-    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", comp) + chunk(b"IEND", b"")
+_OBS_MESSAGES = frozenset({WM_ERASEBKGND, WM_MOUSEWHEEL, WM_CLOSE, WM_DESTROY})
 
 
-def create_shared_fonts() -> tuple[w.HFONT, w.HFONT]:
-    mono = gdi32.CreateFontW(-14, 0, 0, 0, 400, 0, 0, 0, 1, 0, 0, 0, 0, "Consolas")
-    ui = gdi32.CreateFontW(-14, 0, 0, 0, 700, 0, 0, 0, 1, 0, 0, 0, 0, "Segoe UI")
-    return mono, ui
+def _obs_wndproc(hwnd: w.HWND, msg: int, wparam: w.WPARAM, lparam: w.LPARAM) -> w.LPARAM:
+    if msg in _OBS_MESSAGES:
+        obs = _OBS_WINDOWS.get(hwnd)
+        if obs is not None:
+            return obs._wndproc(hwnd, msg, wparam, lparam)
+    return _DefWindowProcW(hwnd, msg, wparam, lparam)
+
+
+_OBS_WNDPROC = WNDPROC(_obs_wndproc)
+
+
+def _register_obs_class(hinst: w.HINSTANCE) -> bool:
+    global _obs_class_atom
+    brush = get_brush(OBS_DEFAULT_COLOR)
+    with _OBS_CLASS_LOCK:
+        if _obs_class_atom:
+            return True
+        wc = WNDCLASSEXW(
+            cbSize=ctypes.sizeof(WNDCLASSEXW),
+            style=CS_HREDRAW | CS_VREDRAW,
+            lpfnWndProc=_OBS_WNDPROC,
+            cbClsExtra=0,
+            cbWndExtra=0,
+            hInstance=hinst,
+            hIcon=None,
+            hCursor=user32.LoadCursorW(None, MAKEINTRESOURCEW(IDC_ARROW)),
+            hbrBackground=brush,
+            lpszMenuName=None,
+            lpszClassName=OBS_CLASS_NAME,
+            hIconSm=None,
+        )
+        _obs_class_atom = user32.RegisterClassExW(ctypes.byref(wc))
+        if not _obs_class_atom and ctypes.get_last_error() == 1410:
+            _obs_class_atom = -1
+        return bool(_obs_class_atom)
 
 
 @dataclass(slots=True)
 class LabeledObsWindow:
     hwnd: w.HWND | None = None
     edit: w.HWND | None = None
-    thread: threading.Thread | None = None
-    ready: threading.Event = field(default_factory=threading.Event)
-    stop: threading.Event = field(default_factory=threading.Event)
     x: int = 0
     y: int = 0
     w: int = 0
@@ -763,10 +1080,20 @@ class LabeledObsWindow:
     font: w.HFONT = 0
     zoom_num: int = HUD_DEFAULT_ZOOM_NUM
     zoom_den: int = HUD_DEFAULT_ZOOM_DEN
-    _wndproc_ref: WNDPROC | None = None
+    visible: bool = False
+    dirty: bool = False
+    _shown_label: str | None = None
+    _shown_zoom: tuple[int, int] = (0, 0)
+
+    _ALPHA = ctypes.c_ubyte(int(255 * OBS_OPACITY / 100))
 
     def _wndproc(self, hwnd: w.HWND, msg: int, wparam: w.WPARAM, lparam: w.LPARAM) -> w.LPARAM:
         try:
+            if msg == WM_ERASEBKGND:
+                r = RECT()
+                user32.GetClientRect(hwnd, ctypes.byref(r))
+                user32.FillRect(wparam, ctypes.byref(r), get_brush(self.color))
+                return 1
             if msg == WM_MOUSEWHEEL:
                 delta = ctypes.c_short(wparam >> 16).value
                 ctrl = bool(user32.GetAsyncKeyState(0x11) & 0x8000)
@@ -775,142 +1102,271 @@ class LabeledObsWindow:
                         self.zoom_num = min(400, int(self.zoom_num * 1.1))
                     else:
                         self.zoom_num = max(20, int(self.zoom_num * 0.9))
-                    if self.edit:
-                        user32.SendMessageW(self.edit, EM_SETZOOM, self.zoom_num, self.zoom_den)
+                    self._set_zoom()
                     return 0
-            if msg in (WM_CLOSE, WM_DESTROY):
-                self.stop.set()
-                if msg == WM_CLOSE:
-                    user32.DestroyWindow(hwnd)
+            if msg == WM_CLOSE:
+                self.hide()
+                user32.ShowWindow(hwnd, SW_HIDE)
+                return 0
+            if msg == WM_DESTROY:
+                _OBS_WINDOWS.pop(hwnd, None)
+                self.hwnd = None
+                self.edit = None
                 return 0
         except Exception:
             pass
-        return user32.DefWindowProcW(hwnd, msg, wparam, lparam)
+        return _DefWindowProcW(hwnd, msg, wparam, lparam)
 
-    def _thread(self) -> None:
-        hinst = kernel32.GetModuleHandleW(None)
-        self._wndproc_ref = WNDPROC(self._wndproc)
-        brush = gdi32.CreateSolidBrush(self.color)
-
-        wc = WNDCLASSEXW(
-            cbSize=ctypes.sizeof(WNDCLASSEXW),
-            style=CS_HREDRAW | CS_VREDRAW,
-            lpfnWndProc=self._wndproc_ref,
-            cbClsExtra=0,
-            cbWndExtra=0,
-            hInstance=hinst,
-            hIcon=None,
-            hCursor=user32.LoadCursorW(None, MAKEINTRESOURCEW(IDC_ARROW)),
-            hbrBackground=brush,
-            lpszMenuName=None,
-            lpszClassName="FRANZLabeledObs",
-            hIconSm=None,
-        )
-        if not user32.RegisterClassExW(ctypes.byref(wc)) and ctypes.get_last_error() != 1410:
-            self.ready.set()
-            return
-
-        self.hwnd = user32.CreateWindowExW(WS_EX_TOPMOST | WS_EX_LAYERED | WS_EX_TOOLWINDOW, "FRANZLabeledObs", "", WS_POPUP | WS_VISIBLE, self.x, self.y, self.w, self.h, None, None, hinst, None)
+    def _create(self, hinst: w.HINSTANCE) -> bool:
+        self.hwnd = user32.CreateWindowExW(WS_EX_TOPMOST | WS_EX_LAYERED | WS_EX_TOOLWINDOW, _CLS_OBS, _EMPTY_W, WS_POPUP, 0, 0, 80, 60, None, None, hinst, None)
         if not self.hwnd:
-            self.ready.set()
-            return
-
-        user32.SetLayeredWindowAttributes(self.hwnd, self.color, ctypes.c_ubyte(int(255 * OBS_OPACITY / 100)), LWA_ALPHA)
-
-        self.edit = user32.CreateWindowExW(0, "RICHEDIT50W", "", WS_CHILD | WS_VISIBLE | ES_MULTILINE | ES_AUTOVSCROLL | ES_READONLY, 5, 5, max(10, self.w - 10), max(10, self.h - 10), self.hwnd, None, hinst, None)
-        if self.edit:
-            if self.font:
-                user32.SendMessageW(self.edit, WM_SETFONT, self.font, 1)
-            user32.SendMessageW(self.edit, EM_SETBKGNDCOLOR, 0, self.color)
-            user32.SendMessageW(self.edit, EM_SETZOOM, self.zoom_num, self.zoom_den)
-            user32.SetWindowTextW(self.edit, self.label)
-
-        user32.ShowWindow(self.hwnd, SW_SHOWNOACTIVATE)
-        user32.SetWindowPos(self.hwnd, HWND_TOPMOST, 0, 0, 0, 0, SWP_NOMOVE | SWP_NOSIZE | SWP_NOACTIVATE | SWP_SHOWWINDOW)
-        self.ready.set()
+            return False
+        _OBS_WINDOWS[self.hwnd] = self
+        user32.SetLayeredWindowAttributes(self.hwnd, self.color, self._ALPHA, LWA_ALPHA)
+        self.edit = user32.CreateWindowExW(0, _CLS_RICHEDIT, _EMPTY_W, WS_CHILD | WS_VISIBLE | ES_MULTILINE | ES_AUTOVSCROLL | ES_READONLY, 5, 5, 70, 50, self.hwnd, None, hinst, None)
+        return True
 
-        msg = MSG()
-        while not self.stop.is_set():
-            if user32.GetMessageW(ctypes.byref(msg), None, 0, 0) in (0, -1):
-                break
-            user32.TranslateMessage(ctypes.byref(msg))
-            user32.DispatchMessageW(ctypes.byref(msg))
+    def _apply_content(self) -> None:
+        if not self.edit or not self.visible:
+            return
+        if self.font:
+            _SendMessageW(self.edit, WM_SETFONT, self.font, 1)
+        _SendMessageW(self.edit, EM_SETBKGNDCOLOR, 0, self.color)
+        self._set_zoom()
+        if self.label != self._shown_label:
+            _SetWindowTextW(self.edit, self.label)
+            self._shown_label = self.label
+        _MoveWindow(self.edit, 5, 5, max(10, self.w - 10), max(10, self.h - 10), True)
+
+    def _set_zoom(self) -> None:
+        zoom = (self.zoom_num, self.zoom_den)
+        if self.edit and zoom != self._shown_zoom:
+            _SendMessageW(self.edit, EM_SETZOOM, *zoom)
+            self._shown_zoom = zoom
+
+    def _pos_args(self) -> tuple[int, int, int, int, int]:
+        if self.visible:
+            return self.x, self.y, self.w, self.h, SWP_NOACTIVATE | SWP_SHOWWINDOW | SWP_NOSENDCHANGING
+        return 0, 0, 0, 0, SWP_NOMOVE | SWP_NOSIZE | SWP_NOZORDER | SWP_NOACTIVATE | SWP_HIDEWINDOW
 
     def show(self, cx: int, cy: int, sw: int, sh: int, label: str, color: int, font: w.HFONT, zoom_num: int, zoom_den: int) -> None:
-        self.w = max(80, int(sw * OBS_NORM_W))
-        self.h = max(60, int(sh * OBS_NORM_H))
-        self.x = clamp(cx - self.w // 2, 0, max(0, sw - self.w))
-        self.y = clamp(cy - self.h // 2, 0, max(0, sh - self.h))
-        self.label = label
-        self.color = color
-        self.font = font
-        self.zoom_num = zoom_num
-        self.zoom_den = zoom_den
-        self.ready.clear()
-        self.stop.clear()
-        self.thread = threading.Thread(target=self._thread, daemon=True)
-        self.thread.start()
-        self.ready.wait(timeout=1.0)
+        ow = max(80, int(sw * OBS_NORM_W))
+        oh = max(60, int(sh * OBS_NORM_H))
+        state = (clamp(cx - ow // 2, 0, max(0, sw - ow)), clamp(cy - oh // 2, 0, max(0, sh - oh)), ow, oh, label, color, font, zoom_num, zoom_den)
+        if self.visible and state == (self.x, self.y, self.w, self.h, self.label, self.color, self.font, self.zoom_num, self.zoom_den):
+            return
+        self.x, self.y, self.w, self.h, self.label, self.color, self.font, self.zoom_num, self.zoom_den = state
+        self.visible = True
+        self.dirty = True
 
     def hide(self) -> None:
-        self.stop.set()
-        if self.hwnd:
-            user32.PostMessageW(self.hwnd, WM_CLOSE, 0, 0)
-        if self.thread:
-            self.thread.join(timeout=0.5)
-        self.hwnd = None
+        if self.visible:
+            self.visible = False
+            self.dirty = True
 
 
 @dataclass(slots=True)
 class ObsManager:
     windows: list[LabeledObsWindow] = field(default_factory=list)
+    thread: threading.Thread | None = None
+    thread_id: int = 0
+    ready: bool = False
+    _cv: threading.Condition = field(default_factory=threading.Condition)
+    stop_handle: w.HANDLE | None = None
+    _last_key: tuple[Any, ...] | None = None
+    _posted: int = 0
+    _applied: int = 0
+
+    def _thread(self) -> None:
+        hinst = kernel32.GetModuleHandleW(None)
+        _load_richedit()
+        self.thread_id = kernel32.GetCurrentThreadId()
+        if _register_obs_class(hinst):
+            for _ in range(OBS_MAX_TARGETS):
+                obs = LabeledObsWindow()
+                if obs._create(hinst):
+                    self.windows.append(obs)
+        with self._cv:
+            self.ready = True
+            self._cv.notify_all()
+
+        _pump_messages(self.stop_handle, self._on_thread_msg)
+
+        for obs in self.windows:
+            if obs.hwnd:
+                user32.DestroyWindow(obs.hwnd)
+
+    def _on_thread_msg(self, message: int) -> None:
+        if message == WM_APP_OBS_UPDATE:
+            gen = self._posted
+            self._apply()
+            with self._cv:
+                self._applied = gen
+                self._cv.notify_all()
+
+    def _apply(self) -> None:
+        live = [obs for obs in self.windows if obs.hwnd and obs.dirty]
+        if not live:
+            return
+        for obs in live:
+            obs.dirty = False
+            obs._apply_content()
+        positions = [(obs.hwnd, *obs._pos_args()) for obs in live]
+        hdwp = user32.BeginDeferWindowPos(len(positions))
+        for hwnd, x, y, cw, ch, flags in positions:
+            if not hdwp:
+                break
+            hdwp = user32.DeferWindowPos(hdwp, hwnd, HWND_TOPMOST, x, y, cw, ch, flags)
+        if hdwp and user32.EndDeferWindowPos(hdwp):
+            return
+        for hwnd, x, y, cw, ch, flags in positions:
+            _SetWindowPos(hwnd, HWND_TOPMOST, x, y, cw, ch, flags)
+
+    def _post_apply(self) -> None:
+        if self.thread_id and any(obs.dirty for obs in self.windows):
+            self._posted += 1
+            user32.PostThreadMessageW(self.thread_id, WM_APP_OBS_UPDATE, 0, 0)
+
+    def _ensure_thread(self) -> None:
+        if self.thread is None:
+            self.stop_handle = kernel32.CreateEventW(None, True, False, None)
+            self.thread = threading.Thread(target=self._thread, daemon=True)
+            self.thread.start()
+            with self._cv:
+                self._cv.wait_for(lambda: self.ready, timeout=2.0)
 
     def show_multiple(self, targets: list[dict[str, Any]], sw: int, sh: int, conv: Coord, font: w.HFONT, zoom_num: int, zoom_den: int, color: int = OBS_DEFAULT_COLOR) -> None:
-        self.hide_all()
-        for t in targets[:OBS_MAX_TARGETS]:
-            x_norm = float(t.get("x", 500))
-            y_norm = float(t.get("y", 500))
-            label = str(t.get("label", "")).strip()
+        self._ensure_thread()
+        targets = targets[:OBS_MAX_TARGETS]
+        key = (tuple((t.get("x", 500), t.get("y", 500), t.get("label", "")) for t in targets), sw, sh, color, font, zoom_num, zoom_den)
+        if key == self._last_key and all(obs.visible for obs in self.windows[: len(targets)]):
+            return
+        self._last_key = key
+        xs = [float(t.get("x", 500)) for t in targets]
+        ys = [float(t.get("y", 500)) for t in targets]
+        oxs, oys = conv.to_screen_batch(xs, ys)
+        for i, obs in enumerate(self.windows):
+            if i >= len(targets):
+                obs.hide()
+                continue
+            label = str(targets[i].get("label", "")).strip()
             if not label:
-                label = f"({int(x_norm)},{int(y_norm)})"
-            ox, oy = conv.to_screen(x_norm, y_norm)
-            obs = LabeledObsWindow()
-            obs.show(ox, oy, sw, sh, label, color, font, zoom_num, zoom_den)
-            self.windows.append(obs)
+                label = f"({int(xs[i])},{int(ys[i])})"
+            obs.show(oxs[i], oys[i], sw, sh, label, color, font, zoom_num, zoom_den)
+        self._post_apply()
 
-    def hide_all(self) -> None:
+    def hide_all(self, wait: bool = False) -> None:
+        self._last_key = None
         for obs in self.windows:
             obs.hide()
+        self._post_apply()
+        if wait:
+            with self._cv:
+                self._cv.wait_for(lambda: self._applied >= self._posted, timeout=0.5)
+
+    def close(self) -> None:
+        if self.thread is None:
+            return
+        kernel32.SetEvent(self.stop_handle)
+        self.thread.join(timeout=1.0)
+        if not self.thread.is_alive():
+            kernel32.CloseHandle(self.stop_handle)
+            self.stop_handle = None
+        self.thread = None
+        self.ready = False
         self.windows.clear()
 
 
+HUD_CLASS_NAME = "FRANZHUD"
+_CLS_HUD = ctypes.c_wchar_p(HUD_CLASS_NAME)
+
+_HUD_WINDOWS: dict[int, HUD] = {}
+_HUD_CLASS_LOCK = threading.Lock()
+_hud_class_atom = 0
+
+
+_HUD_MESSAGES = frozenset({WM_COMMAND, WM_MOUSEWHEEL, WM_SIZE, WM_CLOSE, WM_DESTROY})
+
+
+def _hud_wndproc(hwnd: w.HWND, msg: int, wparam: w.WPARAM, lparam: w.LPARAM) -> w.LPARAM:
+    if msg in _HUD_MESSAGES:
+        hud = _HUD_WINDOWS.get(hwnd)
+        if hud is not None:
+            return hud._wndproc(hwnd, msg, wparam, lparam)
+    return _DefWindowProcW(hwnd, msg, wparam, lparam)
+
+
+_HUD_WNDPROC = WNDPROC(_hud_wndproc)
+
+
+def _register_hud_class(hinst: w.HINSTANCE) -> bool:
+    global _hud_class_atom
+    with _HUD_CLASS_LOCK:
+        if _hud_class_atom:
+            return True
+        wc = WNDCLASSEXW(
+            cbSize=ctypes.sizeof(WNDCLASSEXW),
+            style=CS_HREDRAW | CS_VREDRAW,
+            lpfnWndProc=_HUD_WNDPROC,
+            cbClsExtra=0,
+            cbWndExtra=0,
+            hInstance=hinst,
+            hIcon=None,
+            hCursor=user32.LoadCursorW(None, MAKEINTRESOURCEW(IDC_ARROW)),
+            hbrBackground=w.HANDLE(COLOR_WINDOW + 1),
+            lpszMenuName=None,
+            lpszClassName=HUD_CLASS_NAME,
+            hIconSm=None,
+        )
+        _hud_class_atom = user32.RegisterClassExW(ctypes.byref(wc))
+        if not _hud_class_atom and ctypes.get_last_error() == 1410:
+            _hud_class_atom = -1
+        return bool(_hud_class_atom)
+
+
 @dataclass(slots=True)
 class HUD:
     hwnd: w.HWND | None = None
     edit: w.HWND | None = None
     btn: w.HWND | None = None
     thread: threading.Thread | None = None
-    ready: threading.Event = field(default_factory=threading.Event)
-    stop: threading.Event = field(default_factory=threading.Event)
+    ready: bool = False
+    stopped: bool = False
     paused: bool = True
-    pause_event: threading.Event = field(default_factory=threading.Event)
+    _cv: threading.Condition = field(default_factory=threading.Condition)
     zoom_num: int = HUD_DEFAULT_ZOOM_NUM
     zoom_den: int = HUD_DEFAULT_ZOOM_DEN
     font_mono: w.HFONT = 0
     font_ui: w.HFONT = 0
-    _wndproc_ref: WNDPROC | None = None
+    stop_handle: w.HANDLE | None = None
+    _shown_text: str | None = None
+    _shown_zoom: tuple[int, int] = (0, 0)
     _BTN_ID: int = 1001
 
     def _set_paused(self, p: bool) -> None:
         self.paused = p
         if self.btn:
-            user32.SetWindowTextW(self.btn, "RESUME" if p else "PAUSE")
+            _SetWindowTextW(self.btn, _LBL_RESUME if p else _LBL_PAUSE)
         if self.edit:
-            user32.SendMessageW(self.edit, EM_SETREADONLY, 0 if p else 1, 0)
+            _SendMessageW(self.edit, EM_SETREADONLY, 0 if p else 1, 0)
         if p:
-            self.pause_event.clear()
-        else:
-            self.pause_event.set()
+            self._shown_text = None
+        self._notify()
+
+    def _notify(self) -> None:
+        with self._cv:
+            self._cv.notify_all()
+
+    def _signal_ready(self) -> None:
+        with self._cv:
+            self.ready = True
+            self._cv.notify_all()
+
+    def _signal_stop(self) -> None:
+        self.stopped = True
+        if self.stop_handle:
+            kernel32.SetEvent(self.stop_handle)
+        self._notify()
 
     def _layout(self) -> None:
         if not self.hwnd:
@@ -922,10 +1378,10 @@ class HUD:
         pad, bh = 10, 40
         by = max(pad, ch - pad - bh)
         if self.edit:
-            user32.MoveWindow(self.edit, pad, pad, max(10, cw - 20), max(10, by - 2 * pad), True)
-            user32.SendMessageW(self.edit, EM_SETTARGETDEVICE, 0, 0)
+            _MoveWindow(self.edit, pad, pad, max(10, cw - 20), max(10, by - 2 * pad), True)
+            _SendMessageW(self.edit, EM_SETTARGETDEVICE, 0, 0)
         if self.btn:
-            user32.MoveWindow(self.btn, pad, by, max(80, cw - 20), bh, True)
+            _MoveWindow(self.btn, pad, by, max(80, cw - 20), bh, True)
 
     def _wndproc(self, hwnd: w.HWND, msg: int, wparam: w.WPARAM, lparam: w.LPARAM) -> w.LPARAM:
         try:
@@ -940,98 +1396,86 @@ class HUD:
                         self.zoom_num = min(400, int(self.zoom_num * 1.1))
                     else:
                         self.zoom_num = max(20, int(self.zoom_num * 0.9))
-                    if self.edit:
-                        user32.SendMessageW(self.edit, EM_SETZOOM, self.zoom_num, self.zoom_den)
+                    self._set_zoom()
                     return 0
             if msg == WM_SIZE:
                 self._layout()
             if msg in (WM_CLOSE, WM_DESTROY):
-                self.stop.set()
-                self.pause_event.set()
+                self._signal_stop()
                 if msg == WM_CLOSE:
                     user32.DestroyWindow(hwnd)
+                else:
+                    _HUD_WINDOWS.pop(hwnd, None)
+                    self.hwnd = self.edit = self.btn = None
                 return 0
         except Exception:
             pass
-        return user32.DefWindowProcW(hwnd, msg, wparam, lparam)
+        return _DefWindowProcW(hwnd, msg, wparam, lparam)
 
     def _thread(self) -> None:
         hinst = kernel32.GetModuleHandleW(None)
+        _load_richedit()
         sw, sh = user32.GetSystemMetrics(0), user32.GetSystemMetrics(1)
         w_px = min(max(HUD_MIN_W, int(sw * HUD_NORM_W)), sw)
         h_px = min(max(HUD_MIN_H, int(sh * HUD_NORM_H)), sh)
         x = clamp(int(sw * HUD_NORM_X), 0, max(0, sw - w_px))
         y = clamp(int(sh * HUD_NORM_Y), 0, max(0, sh - h_px))
 
-        self._wndproc_ref = WNDPROC(self._wndproc)
-        wc = WNDCLASSEXW(
-            cbSize=ctypes.sizeof(WNDCLASSEXW),
-            style=CS_HREDRAW | CS_VREDRAW,
-            lpfnWndProc=self._wndproc_ref,
-            cbClsExtra=0,
-            cbWndExtra=0,
-            hInstance=hinst,
-            hIcon=None,
-            hCursor=user32.LoadCursorW(None, MAKEINTRESOURCEW(IDC_ARROW)),
-            hbrBackground=w.HANDLE(COLOR_WINDOW + 1),
-            lpszMenuName=None,
-            lpszClassName="FRANZHUD",
-            hIconSm=None,
-        )
-        if not user32.RegisterClassExW(ctypes.byref(wc)) and ctypes.get_last_error() != 1410:
-            self.ready.set()
+        if not _register_hud_class(hinst):
+            self._signal_ready()
             return
 
-        self.hwnd = user32.CreateWindowExW(WS_EX_TOPMOST | WS_EX_LAYERED, "FRANZHUD", "FRANZ", WS_OVERLAPPED | WS_CAPTION | WS_SYSMENU | WS_THICKFRAME | WS_MINIMIZEBOX | WS_VISIBLE, x, y, w_px, h_px, None, None, hinst, None)
+        self.hwnd = user32.CreateWindowExW(WS_EX_TOPMOST | WS_EX_LAYERED, _CLS_HUD, "FRANZ", WS_OVERLAPPED | WS_CAPTION | WS_SYSMENU | WS_THICKFRAME | WS_MINIMIZEBOX | WS_VISIBLE, x, y, w_px, h_px, None, None, hinst, None)
         if not self.hwnd:
-            self.ready.set()
+            self._signal_ready()
             return
+        _HUD_WINDOWS[self.hwnd] = self
 
         user32.SetLayeredWindowAttributes(self.hwnd, 0, ctypes.c_ubyte(255), LWA_ALPHA)
 
         self.font_mono, self.font_ui = create_shared_fonts()
 
-        self.edit = user32.CreateWindowExW(0, "RICHEDIT50W", "", WS_CHILD | WS_VISIBLE | WS_VSCROLL | ES_MULTILINE | ES_AUTOVSCROLL, 0, 0, 10, 10, self.hwnd, None, hinst, None)
+        self.edit = user32.CreateWindowExW(0, _CLS_RICHEDIT, _EMPTY_W, WS_CHILD | WS_VISIBLE | WS_VSCROLL | ES_MULTILINE | ES_AUTOVSCROLL, 0, 0, 10, 10, self.hwnd, None, hinst, None)
         if self.edit:
             if self.font_mono:
-                user32.SendMessageW(self.edit, WM_SETFONT, self.font_mono, 1)
-            user32.SendMessageW(self.edit, EM_SETBKGNDCOLOR, 0, HUD_BG_COLOR)
-            user32.SendMessageW(self.edit, EM_SETZOOM, self.zoom_num, self.zoom_den)
+                _SendMessageW(self.edit, WM_SETFONT, self.font_mono, 1)
+            _SendMessageW(self.edit, EM_SETBKGNDCOLOR, 0, HUD_BG_COLOR)
+            self._set_zoom()
 
-        self.btn = user32.CreateWindowExW(0, "BUTTON", "RESUME", WS_CHILD | WS_VISIBLE, 0, 0, 10, 10, self.hwnd, w.HMENU(self._BTN_ID), hinst, None)
+        self.btn = user32.CreateWindowExW(0, _CLS_BUTTON, _LBL_RESUME, WS_CHILD | WS_VISIBLE, 0, 0, 10, 10, self.hwnd, w.HMENU(self._BTN_ID), hinst, None)
         if self.btn and self.font_ui:
-            user32.SendMessageW(self.btn, WM_SETFONT, self.font_ui, 1)
+            _SendMessageW(self.btn, WM_SETFONT, self.font_ui, 1)
 
         self._layout()
         self._set_paused(True)
         user32.ShowWindow(self.hwnd, SW_SHOWNOACTIVATE)
-        user32.SetWindowPos(self.hwnd, HWND_TOPMOST, 0, 0, 0, 0, SWP_NOMOVE | SWP_NOSIZE | SWP_NOACTIVATE | SWP_SHOWWINDOW)
-        self.ready.set()
+        _SetWindowPos(self.hwnd, HWND_TOPMOST, 0, 0, 0, 0, SWP_NOMOVE | SWP_NOSIZE | SWP_NOACTIVATE | SWP_SHOWWINDOW | SWP_NOSENDCHANGING)
+        self._signal_ready()
 
-        msg = MSG()
-        while not self.stop.is_set():
-            if user32.GetMessageW(ctypes.byref(msg), None, 0, 0) in (0, -1):
-                break
-            user32.TranslateMessage(ctypes.byref(msg))
-            user32.DispatchMessageW(ctypes.byref(msg))
+        _pump_messages(self.stop_handle)
+        if self.hwnd:
+            user32.DestroyWindow(self.hwnd)
 
     def __enter__(self) -> HUD:
-        self.ready.clear()
-        self.stop.clear()
-        self.pause_event.clear()
+        self.ready = False
+        self.stopped = False
+        self.stop_handle = kernel32.CreateEventW(None, True, False, None)
         self.thread = threading.Thread(target=self._thread, daemon=True)
         self.thread.start()
-        self.ready.wait(timeout=2.0)
-        time.sleep(0.2)
+        with self._cv:
+            self._cv.wait_for(lambda: self.ready, timeout=2.0)
+        deadline = time.perf_counter() + 0.2
+        while self.hwnd and not user32.IsWindowVisible(self.hwnd) and time.perf_counter() < deadline:
+            time.sleep(0.005)
         return self
 
     def __exit__(self, *_: Any) -> None:
-        self.stop.set()
-        self.pause_event.set()
-        if self.hwnd:
-            user32.PostMessageW(self.hwnd, WM_CLOSE, 0, 0)
+        self._signal_stop()
         if self.thread:
             self.thread.join(timeout=1.0)
+            if not self.thread.is_alive() and self.stop_handle:
+                kernel32.CloseHandle(self.stop_handle)
+                self.stop_handle = None
 
     def get_text(self) -> str:
         if not self.edit:
@@ -1043,36 +1487,155 @@ class HUD:
         user32.GetWindowTextW(self.edit, buf, n + 1)
         return buf.value
 
+    def _set_zoom(self) -> None:
+        zoom = (self.zoom_num, self.zoom_den)
+        if self.edit and zoom != self._shown_zoom:
+            _SendMessageW(self.edit, EM_SETZOOM, *zoom)
+            self._shown_zoom = zoom
+
     def update(self, story: str) -> None:
-        if self.edit:
-            user32.SetWindowTextW(self.edit, story)
-            user32.SendMessageW(self.edit, EM_SETZOOM, self.zoom_num, self.zoom_den)
+        if not self.edit or story == self._shown_text:
+            return
+        _SetWindowTextW(self.edit, story)
+        self._shown_text = story
+        self._set_zoom()
 
     def wait(self) -> None:
-        while self.paused and not self.stop.is_set():
-            self.pause_event.wait(timeout=0.1)
-
-
-
-def call_vlm(png: bytes) -> tuple[str, dict[str, Any]]:
-    payload = {
-        "model": MODEL_NAME,
-        "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64.b64encode(png).decode('ascii')}"}},
-                    {"type": "text", "text": "Call exactly one tool. Coordinates are normalized integers 0-1000. Always include story."},
-                ],
-            },
-        ],
-        "tools": TOOLS,
-        "tool_choice": "required",
-        **SAMPLING,
-    }
-    req = urllib.request.Request(API_URL, json.dumps(payload).encode("utf-8"), {"Content-Type": "application/json"})
-    data = json.load(urllib.request.urlopen(req, timeout=120))
+        with self._cv:
+            while not self._cv.wait_for(lambda: not self.paused or self.stopped, timeout=0.1):
+                pass
+
+    def wait_for(self, fut: concurrent.futures.Future[Any]) -> bool:
+        fut.add_done_callback(lambda _: self._notify())
+        with self._cv:
+            while not self._cv.wait_for(lambda: fut.done() or self.stopped or self.paused, timeout=0.1):
+                pass
+        return fut.done()
+
+
+
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+else:
+
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    _json_loads = json.loads
+
+
+_TOOLS_JSON = json.dumps(TOOLS, ensure_ascii=False)
+_TOOLS_BYTES = _TOOLS_JSON.encode("utf-8")
+_REQUEST_HEAD = b'{"model":' + json.dumps(MODEL_NAME).encode("utf-8") + b',"messages":'
+_REQUEST_TAIL = b',"tools":' + _TOOLS_BYTES + b',"tool_choice":"required"' + (b"," + json.dumps(SAMPLING).encode("utf-8")[1:] if SAMPLING else b"}")
+
+_MESSAGES_HEAD = b"[" + _json_dumps({"role": "system", "content": SYSTEM_PROMPT}) + b',{"role":"user","content":[{"type":"image_url","image_url":{"url":"data:'
+_MESSAGES_TAIL = b'"}},' + _json_dumps({"type": "text", "text": "Call exactly one tool. Coordinates are normalized integers 0-1000. Always include story."}) + b"]}]"
+_REQUEST_SUFFIX = _MESSAGES_TAIL + _REQUEST_TAIL
+
+
+@functools.cache
+def _request_prefix(mime: str) -> bytes:
+    return _REQUEST_HEAD + _MESSAGES_HEAD + mime.encode("ascii") + b";base64,"
+
+
+_API_PARTS = urllib.parse.urlsplit(API_URL)
+_API_PATH = _API_PARTS.path or "/"
+_API_HEADERS = {"Content-Type": "application/json", "Connection": "keep-alive"}
+_vlm_conn: http.client.HTTPConnection | None = None
+
+
+def _vlm_connection(timeout: float) -> http.client.HTTPConnection:
+    global _vlm_conn
+    if _vlm_conn is None:
+        cls = http.client.HTTPSConnection if _API_PARTS.scheme == "https" else http.client.HTTPConnection
+        _vlm_conn = cls(_API_PARTS.hostname or "localhost", _API_PARTS.port, timeout=timeout)
+    elif _vlm_conn.timeout != timeout:
+        _vlm_conn.timeout = timeout
+        if _vlm_conn.sock is not None:
+            _vlm_conn.sock.settimeout(timeout)
+    return _vlm_conn
+
+
+def _close_vlm_connection() -> None:
+    global _vlm_conn
+    if _vlm_conn is not None:
+        _vlm_conn.close()
+        _vlm_conn = None
+
+
+def _abort_vlm_connection() -> None:
+    conn = _vlm_conn
+    sock = conn.sock if conn is not None else None
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def _post_json_once(body: tuple[bytes, ...], timeout: float, abort: threading.Event | None = None) -> bytes:
+    conn = _vlm_connection(timeout)
+    reused = conn.sock is not None
+    try:
+        if not reused:
+            conn.timeout = min(timeout, CONNECT_TIMEOUT)
+            conn.connect()
+            conn.timeout = timeout
+            conn.sock.settimeout(timeout)
+        if abort is not None and abort.is_set():
+            _close_vlm_connection()
+            raise ConnectionAbortedError("VLM request aborted")
+        conn.request("POST", _API_PATH, body, {**_API_HEADERS, "Content-Length": str(sum(map(len, body)))})
+        resp = conn.getresponse()
+        if resp.length is not None and resp.length > MAX_RESPONSE_BYTES:
+            _close_vlm_connection()
+            raise ValueError(f"VLM response too large: {resp.length} bytes")
+        data = resp.read(MAX_RESPONSE_BYTES + 1)
+    except (http.client.RemoteDisconnected, http.client.BadStatusLine):
+        _close_vlm_connection()
+        if not reused or (abort is not None and abort.is_set()):
+            raise
+        return _post_json_once(body, timeout, abort)
+    except (OSError, http.client.HTTPException):
+        _close_vlm_connection()
+        raise
+    if len(data) > MAX_RESPONSE_BYTES:
+        _close_vlm_connection()
+        raise ValueError(f"VLM response exceeds {MAX_RESPONSE_BYTES} bytes")
+    if resp.will_close:
+        _close_vlm_connection()
+    if resp.status != 200:
+        raise ValueError(f"VLM HTTP {resp.status} {resp.reason}")
+    return data
+
+
+def _post_json(body: tuple[bytes, ...], timeout: float, log_path: Path | None = None, abort: threading.Event | None = None) -> bytes:
+    attempt = 0
+    while True:
+        if abort is not None and abort.is_set():
+            raise ConnectionAbortedError("VLM request aborted")
+        try:
+            return _post_json_once(body, timeout, abort)
+        except (TimeoutError, ConnectionError, http.client.HTTPException) as e:
+            attempt += 1
+            if attempt >= REQUEST_RETRIES or (abort is not None and abort.is_set()):
+                raise
+            delay = 0.5 * 2 ** (attempt - 1)
+            if log_path is not None:
+                ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+                line = f"--- {ts} | vlm retry {attempt}/{REQUEST_RETRIES - 1} in {delay:.1f}s: {e!r}\n"
+                _enqueue_log(log_path, lambda line=line: line)
+            if abort is not None:
+                abort.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+def call_vlm(img: bytes, mime: str = "image/png", timeout: float = REQUEST_TIMEOUT, log_path: Path | None = None, abort: threading.Event | None = None) -> tuple[str, dict[str, Any]]:
+    body = (_request_prefix(mime), base64.b64encode(img), _REQUEST_SUFFIX)
+    data = _json_loads(_post_json(body, timeout, log_path, abort))
     choices = data.get("choices") or []
     if not choices:
         raise ValueError("No choices in VLM response")
@@ -1081,14 +1644,16 @@ def call_vlm(png: bytes) -> tuple[str, dict[str, Any]]:
     if not tool_calls:
         raise ValueError("No tool calls in VLM response")
     fn = (tool_calls[0].get("function") or {})
-    name = str(fn.get("name") or "").strip().lower()
-    if name not in TOOL_NAME_SET:
-        raise ValueError(f"Unknown tool: {name!r}")
+    name = fn.get("name")
+    if not isinstance(name, str) or name not in TOOL_NAME_SET:
+        name = str(name or "").strip().lower()
+        if name not in TOOL_NAME_SET:
+            raise ValueError(f"Unknown tool: {name!r}")
     args_raw = fn.get("arguments", "")
-    if isinstance(args_raw, str):
-        args = json.loads(args_raw) if args_raw.strip() else {}
-    elif isinstance(args_raw, dict):
+    if isinstance(args_raw, dict):
         args = args_raw
+    elif isinstance(args_raw, str):
+        args = _json_loads(args_raw) if args_raw.strip() else {}
     else:
         raise ValueError(f"Invalid arguments type: {type(args_raw).__name__}")
     if not isinstance(args, dict):
@@ -1144,18 +1709,27 @@ def main() -> None:
     parser = argparse.ArgumentParser(description="FRANZ narrative-persistent AI agent")
     parser.add_argument("--test", action="store_true", help="Enable test mode (simulated VLM responses)")
     parser.add_argument("--res", choices=["low", "med", "high"], default="high", help="Screen resolution preset")
+    parser.add_argument("--png", action="store_true", help="Send and dump lossless PNG instead of JPEG (debugging)")
+    parser.add_argument("--request-timeout", type=float, default=REQUEST_TIMEOUT, help="Per-request VLM timeout in seconds")
+    parser.add_argument("--exec-log", choices=EXEC_LOG_MODES, default="full", help="Execution log detail (off, basic=window list, full=with WM_GETTEXT)")
+    parser.add_argument("--no-frame-cache", action="store_true", help="Always call the VLM, even when the screen is unchanged")
+    parser.add_argument("--min-step-interval", type=float, default=0.0, help="Minimum seconds between step starts (0 = run steps back to back)")
     cli_args = parser.parse_args()
 
     test_mode = cli_args.test
     screen_w, screen_h = RES_PRESETS[cli_args.res]
+    use_jpeg = Image is not None and not cli_args.png
+    init_windows_env()
+    mime, ext = ("image/jpeg", "jpg") if use_jpeg else ("image/png", "png")
 
     sw, sh = user32.GetSystemMetrics(0), user32.GetSystemMetrics(1)
     conv = Coord(sw=sw, sh=sh)
 
     dump = DUMP_FOLDER / f"run_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
     dump.mkdir(parents=True, exist_ok=True)
+    log_path = dump / "execution-log.txt" if cli_args.exec_log != "off" else None
 
-    print(f"FRANZ | Screen: {sw}x{sh} | Model: {screen_w}x{screen_h} | TEST_MODE={test_mode}")
+    print(f"FRANZ | Screen: {sw}x{sh} | Model: {screen_w}x{screen_h} | Format: {ext} | TEST_MODE={test_mode}")
     print(f"Dump: {dump}")
     print("PAUSED - edit story in HUD, click RESUME to start")
     print("HUD: CTRL+Scroll to zoom text")
@@ -1164,33 +1738,55 @@ def main() -> None:
         hud.update(DEFAULT_HUD_TEXT)
         step = 0
         obs_mgr = ObsManager()
+        frame_cache = None if test_mode or cli_args.no_frame_cache else FrameCache()
         hud.wait()
 
-        while not hud.stop.is_set():
+        while not hud.stopped:
             hud.wait()
-            if hud.stop.is_set():
+            if hud.stopped:
                 break
 
+            step_start = time.perf_counter()
+            bgra = capture_and_downsample(sw, sh, screen_w, screen_h)
+            frame_hash = frame_dhash(bgra, screen_w, screen_h) if frame_cache is not None else 0
+            if frame_cache is not None and frame_cache.unchanged(frame_hash):
+                time.sleep(FRAME_CACHE_POLL)
+                continue
+
             step += 1
             ts = datetime.now().strftime("%H:%M:%S")
 
-            bgra = capture_screen(sw, sh)
-            png = encode_png(downsample(bgra, sw, sh, screen_w, screen_h), screen_w, screen_h)
-            img_name = f"step{step:03d}.png"
-            (dump / img_name).write_bytes(png)
-            append_execution_log(dump, img_name, sw, sh)
-
-            obs_mgr.hide_all()
-
+            img = encode_jpeg(bgra, screen_w, screen_h) if use_jpeg else encode_png(bgra, screen_w, screen_h)
+            img_name = f"step{step:03d}.{ext}"
+            _IO_POOL.submit((dump / img_name).write_bytes, img)
+            _IO_POOL.submit(append_execution_log, dump, img_name, sw, sh, cli_args.exec_log)
             try:
                 if test_mode:
                     tool, args = call_vlm_test(step)
                 else:
-                    tool, args = call_vlm(png)
+                    abort = threading.Event()
+                    fut = _VLM_POOL.submit(call_vlm, img, mime, cli_args.request_timeout, log_path, abort)
+                    if not hud.wait_for(fut):
+                        abort.set()
+                        fut.cancel()
+                        _abort_vlm_connection()
+                        if hud.stopped:
+                            break
+                        print(f"[{ts}] {step:03d} | VLM request abandoned (paused)")
+                        obs_mgr.hide_all()
+                        continue
+                    tool, args = fut.result()
             except Exception as e:
                 print(f"[{ts}] {step:03d} | VLM ERROR: {e}")
+                obs_mgr.hide_all()
                 time.sleep(1.0)
                 continue
+            if frame_cache is not None:
+                frame_cache.store(frame_hash, tool)
+            if hud.paused:
+                print(f"[{ts}] {step:03d} | {tool} dropped (paused)")
+                obs_mgr.hide_all()
+                continue
             story = str(args["story"]).strip()
 
             print(f"[{ts}] {step:03d} | {tool}")
@@ -1201,6 +1797,7 @@ def main() -> None:
                     targets = [{"x": 500, "y": 500, "label": "Default"}]
                 obs_mgr.show_multiple(targets, sw, sh, conv, hud.font_mono, hud.zoom_num, hud.zoom_den, OBS_DEFAULT_COLOR)
             else:
+                obs_mgr.hide_all(wait=True)
                 try:
                     execute(tool, args, conv)
                 except Exception as e:
@@ -1231,11 +1828,17 @@ def main() -> None:
                             hud.zoom_den,
                             OBS_DEFAULT_COLOR,
                         )
+                    time.sleep(ACTION_SETTLE)
 
             hud.update(story)
-            time.sleep(0.3)
-
-        obs_mgr.hide_all()
+            remaining = cli_args.min_step_interval - (time.perf_counter() - step_start)
+            if remaining > 0:
+                time.sleep(remaining)
+
+        obs_mgr.close()
+    _VLM_POOL.shutdown(wait=False, cancel_futures=True)
+    _IO_POOL.shutdown(wait=True)
+    _flush_log()
 
 
 if __name__ == "__main__":